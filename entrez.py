@@ -2,6 +2,11 @@
 Simple python interface to the NCBI databases (Entrez).
 
 See https://www.ncbi.nlm.nih.gov/books/NBK25500/
+
+To work with many elements, select them on the NCBI servers, with a
+search (select(...)) or by uploading their ids (post(...)), and then
+apply a tool over the selection (apply(...)), which downloads the
+results in batches. See "Retrieving large datasets" in the references.
 """
 
 # Useful references (at https://www.ncbi.nlm.nih.gov/books):
@@ -12,19 +17,33 @@ See https://www.ncbi.nlm.nih.gov/books/NBK25500/
 # * E-utilities:
 #     /NBK25497/#chapter2.The_Nine_Eutilities_in_Brief
 
+import os
 import re
-import urllib.parse, urllib.request, urllib.error
-
-from itertools import groupby
+import gzip
+import time
+import zlib
+import base64
+import hashlib
+import codecs
+import functools
+import threading
+import http.client
+import urllib.parse
+
+from collections import deque
 from xml.etree import ElementTree
 
-import pprint
-import readline
+try:  # lxml, if installed, builds the xml trees faster than ElementTree
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
 
 
 EMAIL = None
 API_KEY = None
 
+EUTILS_HOST = 'eutils.ncbi.nlm.nih.gov'
+
 _tools = {  # valid tools
     'info', 'search', 'post', 'summary', 'fetch', 'link', 'gquery', 'spell',
     'citmatch'}
@@ -38,7 +57,7 @@ _required = {  # required arguments for each tool
     'link': {'db', 'dbfrom'},
     'gquery': {'term'},
     'spell': {'db', 'term'},
-    'citmatch': {'db', 'rettype' 'bdata'}}
+    'citmatch': {'db', 'rettype', 'bdata'}}
 
 _optional = {  # optional arguments for each tool
     'info': {'db', 'version', 'retmode'},
@@ -58,38 +77,251 @@ _optional = {  # optional arguments for each tool
 # For all the available arguments/parameters, see:
 # https://www.ncbi.nlm.nih.gov/books/NBK25499/
 
+_allowed = {  # all the valid arguments for each tool
+    tool: frozenset(_required[tool] | _optional[tool] | {'api_key', 'email'})
+    for tool in _tools}
+
 # We could have a list of valid databases too, for example from
 # https://www.ncbi.nlm.nih.gov/books/NBK25497/table/chapter2.T._entrez_unique_identifiers_ui/
 # but it is missing some, like 'nucleotide'.
 
 
-def query(tool='search', raw_params='', **params):
+def query(tool='search', raw_params='', use_cache=True, **params):
     """Yield the response of a query with the given tool."""
+    data = encode_query(tool, raw_params, params)
+    yield from post_query(tool, data, use_cache)
+
+
+def encode_query(tool, raw_params, params):
+    """Return the (url-encoded) data to send in a query with the given tool."""
     # First make some basic checks.
     assert tool in _tools, \
         f'Invalid web tool "{tool}". Valid tools are: {_tools}'
-    for p in _required[tool]:
-        assert p in params, f'Missing required argument: {p}'
-    for p in params:
-        assert p in _required[tool] | _optional[tool] | {'api_key', 'email'}, \
-            f'Unknown argument: {p}'
+    missing = {p for p in _required[tool] - params.keys()
+               if f'{p}=' not in raw_params}
+    assert not missing, f'Missing required arguments: {missing}'
+    unknown = params.keys() - _allowed[tool]
+    assert not unknown, f'Unknown arguments: {unknown}'
     # We could check more and better than this, but it's probably unnecessary.
 
-    # Make a POST request and yield the lines of the response.
-    url = f'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/e{tool}.fcgi'
-
     if not 'email' in params and not 'email' in raw_params and EMAIL:
         params['email'] = EMAIL
     if not 'api_key' in params and not 'api_key' in raw_params and API_KEY:
         params['api_key'] = API_KEY
 
-    data = (urllib.parse.urlencode(params) + raw_params).encode('ascii')
+    # With doseq, arguments with a list of values (like id=[...]) are
+    # sent as repeated parameters (id=...&id=...).
+    return urllib.parse.urlencode(params, doseq=True) + raw_params
+
+
+def post_query(tool, data, use_cache=True):
+    """Yield the lines of the response to the query with the given data."""
+    if CACHE_DIR and use_cache:
+        yield from cached_post_query(tool, data)
+        return
+
+    # Make a POST request and yield the lines of the response.
+    wait_turn(has_key=('api_key=' in data))
+    yield from http_post(f'/entrez/eutils/e{tool}.fcgi', data.encode('ascii'))
+
+
+# Response cache.
+#
+# If CACHE_DIR is set, the responses are saved there, and the same
+# queries later read them from disk instead of asking the NCBI again.
+# Useful when developing a script and running it again and again.
+
+CACHE_DIR = None  # directory for the cached responses, like '~/.cache/entrez'
+CACHE_TTL = None  # seconds until a cached response is stale (None: never)
+
+def cached_post_query(tool, data):
+    """Yield the lines of the response to the query, from the cache if there."""
+    cache_dir = os.path.expanduser(CACHE_DIR)
+    key = hashlib.sha1(f'{tool}\0{data}'.encode()).hexdigest()
+    fname = os.path.join(cache_dir, key + '.gz')  # compressed, they can be big
+
+    is_fresh = lambda: (CACHE_TTL is None or
+                        time.time() - os.path.getmtime(fname) < CACHE_TTL)
+
+    if os.path.exists(fname) and is_fresh():
+        with gzip.open(fname, 'rt', encoding='utf-8', newline='\n') as f:
+            for line in f:
+                yield line[:-1]  # remove the '\n' that we added
+        return
+
+    # Save the response while yielding it, and only put it in the cache
+    # (atomically, with a rename) once it is complete.
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f'{fname}.{os.getpid()}.{threading.get_ident()}.tmp'
     try:
-        for line_bytes in urllib.request.urlopen(url, data):
-            yield line_bytes.decode('ascii', errors='ignore').rstrip()
-    except urllib.error.HTTPError as e:
-        raise RuntimeError(f'On POST request to {url} with {data}: {e}')
+        with gzip.open(tmp, 'wt', compresslevel=1,  # fast, and good enough
+                       encoding='utf-8', newline='\n') as f:
+            for line in post_query(tool, data, use_cache=False):
+                f.write(line + '\n')
+                yield line
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)  # incomplete response
+
+
+def clear_cache():
+    """Remove all the responses saved in the cache."""
+    cache_dir = os.path.expanduser(CACHE_DIR)
+    if not os.path.isdir(cache_dir):
+        return
+
+    for fname in os.listdir(cache_dir):
+        if re.fullmatch(r'[0-9a-f]{40}\.gz', fname):  # only ours (sha1 names)
+            os.remove(os.path.join(cache_dir, fname))
+
+
+# Connections to the NCBI servers.
+#
+# We keep them alive and reuse them, so consecutive queries (like the
+# ones made by apply()) don't have to open a new connection (and make
+# a new TLS handshake) every time.
+
+_connections = []  # idle connections, ready to be reused
+_max_idle_connections = 10  # as many as simultaneous requests we may do
+
+_transient_errors = {429, 500, 502, 503, 504}  # http statuses worth retrying
+
+def http_post(path, data, retries=4):
+    """Yield the lines of the response to a POST request with data to path."""
+    for attempt in range(retries + 1):
+        connection, response = http_request(path, data)
 
+        if response.status not in _transient_errors or attempt == retries:
+            break
+
+        # Too many requests, or the server is having problems. Wait and retry.
+        connection.close()
+        time.sleep(2**attempt)
+
+    if response.status != 200:
+        connection.close()
+        raise RuntimeError(f'On POST request to https://{EUTILS_HOST}{path} '
+                           f'with {data}: HTTP Error {response.status}: '
+                           f'{response.reason}')
+
+    try:
+        yield from read_lines(response)
+    finally:
+        if (response.isclosed() and not response.will_close and
+            len(_connections) < _max_idle_connections):
+            _connections.append(connection)  # all read, we can reuse it
+        else:
+            connection.close()  # unread data, closed by server, or too many
+
+
+def http_request(path, data):
+    """Return connection and response to a POST request with data to path."""
+    try:
+        connection = _connections.pop()
+        reused = True
+    except IndexError:
+        connection = new_connection()
+        reused = False
+
+    headers = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Accept-Encoding': 'gzip'}  # much less to download for big ones
+    try:
+        connection.request('POST', path, data, headers)
+        response = connection.getresponse()
+    except (http.client.HTTPException, OSError):
+        connection.close()
+        if not reused:
+            raise
+        # The server probably closed the idle connection. Try a new one.
+        connection = new_connection()
+        connection.request('POST', path, data, headers)
+        response = connection.getresponse()
+
+    return connection, response
+
+
+def new_connection():
+    """Return a new connection to the eutils server, through proxy if any."""
+    import urllib.request  # only needed here (and slow to import)
+
+    # Like urlopen(), use the proxy from the environment (https_proxy).
+    proxy = urllib.request.getproxies().get('https')
+    if not proxy or urllib.request.proxy_bypass(EUTILS_HOST):
+        return http.client.HTTPSConnection(EUTILS_HOST)
+
+    url = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+
+    headers = {}
+    if url.username:  # basic authentication with the proxy
+        user = urllib.parse.unquote(url.username)
+        password = urllib.parse.unquote(url.password or '')
+        credentials = base64.b64encode(f'{user}:{password}'.encode()).decode()
+        headers['Proxy-Authorization'] = f'Basic {credentials}'
+
+    connection = http.client.HTTPSConnection(url.hostname, url.port or 80)
+    connection.set_tunnel(EUTILS_HOST, headers=headers)  # https via CONNECT
+    return connection
+
+
+def read_lines(response, size=4*1024*1024):
+    """Yield the lines of the response, reading and decoding big chunks."""
+    # Much faster than reading and decoding line by line. The incremental
+    # decoder takes care of utf-8 characters split between chunks.
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    chunks = iter(lambda: response.read(size), b'')
+    if response.getheader('Content-Encoding') == 'gzip':
+        chunks = gunzip(chunks)
+
+    # The pieces of the current line are joined only once it is complete,
+    # so very long lines (like a whole sequence) don't take quadratic time.
+    pieces = []
+    for chunk in chunks:
+        pieces.append(decoder.decode(chunk))
+        if '\n' not in pieces[-1]:
+            continue  # the line goes on
+
+        lines = ''.join(pieces).replace('\r\n', '\n').split('\n')
+        pieces = [lines.pop()]  # may end in '\r', if '\r\n' is split in chunks
+        yield from lines
+
+    tail = ''.join(pieces) + decoder.decode(b'', final=True)
+    if tail:
+        yield tail.rstrip('\r')
+
+
+def gunzip(chunks):
+    """Yield the decompressed data from the given chunks of gzipped data."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # gzip format
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+# Rate limiting.
+#
+# The NCBI asks for no more than 3 requests per second, or 10 if we
+# use an API key.
+
+_last_request_time = 0
+_rate_lock = threading.Lock()
+
+def wait_turn(has_key=False):
+    """Sleep if needed to respect the limit of requests per second."""
+    global _last_request_time
+
+    interval = 1 / (10 if has_key else 3)  # minimum time between requests
+
+    with _rate_lock:
+        wait = _last_request_time + interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_request_time = time.monotonic()
+
+
+# To extract the values that reference a selection (all in one pass).
+_selection_regexp = re.compile(r'<(WebEnv|QueryKey|Count)>([^<\s]+)</\1>')
 
 def select(tool, db, previous=None, **params):
     """Use tool on db to select elements and return dict for future queries."""
@@ -105,11 +337,15 @@ def select(tool, db, previous=None, **params):
 
     # Keep the values of WebEnv, QueryKey and Count in the selections dict.
     selections = {}
-    for line in query(tool=tool, db=db, **params):
-        for k in ['WebEnv', 'QueryKey', 'Count']:
-            if k not in selections and f'<{k}>' in line:
-                matches = re.search(f'<{k}>(\\S+)</{k}>', line)
-                selections[k] = matches.groups()[0]
+    # The WebEnv of a selection expires, so we never use cached responses.
+    for line in query(tool=tool, db=db, use_cache=False, **params):
+        # We read all the response anyway (so the connection can be reused),
+        # but stop looking once we have all the values.
+        if len(selections) == 3:  # WebEnv, QueryKey and Count
+            continue
+
+        for match in _selection_regexp.finditer(line):
+            selections.setdefault(*match.groups())  # keep the first ones
 
     assert 'WebEnv' in selections and 'QueryKey' in selections, \
         f'Expected WebEnv and QueryKey in result of selection: {selections}'
@@ -133,13 +369,48 @@ def apply(tool, db, selections, retmax=500, **params):
     assert 'WebEnv' in selections and 'QueryKey' in selections, \
         f'Expected WebEnv and QueryKey in selections: {selections}'
 
+    # All the batches share the same parameters except for retstart, so
+    # we encode them only once.
+    data = encode_query(tool, params.pop('raw_params', ''),
+                        dict(params, db=db, WebEnv=selections['WebEnv'],
+                             query_key=selections['QueryKey'], retmax=retmax))
+
+    # The batches are not cached: they refer to a WebEnv, which is new
+    # every time that the selection is made, so they would never be
+    # read again from the cache.
+    def get_batch(retstart):
+        return list(post_query(tool, f'{data}&retstart={retstart}',
+                               use_cache=False))
+
     # Ask for the results of using tool over the selected elements, in
     # batches of retmax each.
-    for retstart in range(0, int(selections.get('Count', '1')), retmax):
-        yield from query(tool=tool, db=db,
-                         WebEnv=selections['WebEnv'],
-                         query_key=selections['QueryKey'],
-                         retstart=retstart, retmax=retmax, **params)
+    retstarts = range(0, int(selections.get('Count', '1')), retmax)
+
+    if len(retstarts) <= 1:  # simple case, we can stream the only batch
+        for retstart in retstarts:
+            yield from post_query(tool, f'{data}&retstart={retstart}',
+                                  use_cache=False)
+        return
+
+    # Several batches are downloaded concurrently (as many as requests
+    # per second we can make), and yielded in order.
+    from concurrent.futures import ThreadPoolExecutor  # only needed here
+
+    nworkers = 10 if 'api_key=' in data else 3
+    with ThreadPoolExecutor(max_workers=nworkers) as executor:
+        pending = deque(executor.submit(get_batch, retstart)
+                        for retstart in retstarts[:nworkers])
+        try:
+            for retstart in retstarts[nworkers:]:
+                lines = pending.popleft().result()
+                pending.append(executor.submit(get_batch, retstart))
+                yield from lines
+
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()  # in case we stopped early
 
 
 def on_search(term, db, tool, dbfrom=None, **params):
@@ -161,6 +432,19 @@ def on_search(term, db, tool, dbfrom=None, **params):
     yield from apply(tool=tool, db=db, selections=selections, **params)
 
 
+def post(db, ids, **params):
+    """Upload the ids of elements in db and return dict for future queries.
+
+    Like select(), but for elements that we know by their ids. It makes
+    a single request, no matter how many ids there are, and the
+    returned selections can be used in apply().
+    """
+    ids = list(dict.fromkeys(str(x) for x in ids))  # unique, in order
+    selections = select(tool='post', db=db, id=','.join(ids), **params)
+    selections.setdefault('Count', str(len(ids)))  # epost doesn't give it
+    return selections
+
+
 # Convenient translations.
 #
 # Many results come as an xml string, and it would be very nice to
@@ -168,42 +452,25 @@ def on_search(term, db, tool, dbfrom=None, **params):
 
 class Nest:
     def __init__(self, obj):
-        assert type(obj) in [dict, list], 'Can only Nest() dict or list.'
+        assert isinstance(obj, (dict, list)), 'Can only Nest() dict or list.'
         self.obj = obj
+        self._is_list = isinstance(obj, list)
 
     def __getitem__(self, key):
-        if type(self.obj) == list:
-            if type(key) == int:
-                return wrap(self.obj[key])
-
-            try:
-                head, *rest = key.split(None, 1)
-                item = wrap(self.obj[int(head)])
-                return item[rest[0]] if rest else item
-            except ValueError:
-                raise KeyError(key)
-        else:  # dict
-            if key in self.obj:
-                # In the unlikely case that we have a key with whitespace.
-                return wrap(self.obj[key])
-
-            try:
-                head, *rest = key.split(None, 1)
-                item = wrap(self.obj[head])
-                return item[rest[0]] if rest else item
-            except (ValueError, KeyError):
-                raise KeyError(key)
+        return wrap(get_item(self.obj, key))
 
     def __iter__(self):
-        if type(self.obj) == list:
+        # Same as wrap(), inlined because this is called for every element.
+        if self._is_list:
             for obj in self.obj:
-                yield wrap(obj)
+                yield Nest(obj) if isinstance(obj, (dict, list)) else obj
         else:
             for key, value in self.obj.items():
-                yield key, wrap(value)
+                yield key, (Nest(value) if isinstance(value, (dict, list))
+                            else value)
 
     def __eq__(self, value):
-        return (type(value) in [dict, list, Nest] and
+        return (isinstance(value, (dict, list, Nest)) and
                 len(self) == len(value) and
                 all(x == y for x, y in zip(self, wrap(value))))
 
@@ -214,13 +481,13 @@ class Nest:
         return len(self.obj)
 
     def keys(self):
-        if type(self.obj) == list:
+        if self._is_list:
             return list(range(len(self.obj)))
         else:
             return list(self.obj.keys())
 
     def values(self):
-        if type(self.obj) == list:
+        if self._is_list:
             return self.obj
         else:
             return list(self.obj.values())
@@ -230,13 +497,15 @@ class Nest:
 
     def view(self, width=120, depth=4, compact=True, sort_dicts=False):
         """Interactive session to get subcomponents of the object."""
+        import pprint, readline  # only needed (and imported) here
+
         readline_init()
 
         obj = self.obj  # start at the top level (and will select subcomponents)
         path = []  # path to the currently selected subcomponent
 
         while True:
-            if type(obj) == dict:
+            if isinstance(obj, dict):
                 readline_set_completer(list(obj.keys()))
             else:  # list
                 readline_set_completer([str(i) for i in range(len(obj))])
@@ -259,15 +528,15 @@ class Nest:
                               sort_dicts=sort_dicts)
 
             try:
-                item = Nest(obj)[choice]
+                item = get_item(obj, choice)
                 path.append(choice)
 
-                if type(item) != Nest:  # we are done, no more nesting
+                if not isinstance(item, (dict, list)):  # done, no more nesting
                     print("Path: ['%s']" % ' '.join(path))
                     print('Value:', item)
                     return
 
-                obj = item.obj
+                obj = item
             except KeyError:
                 print(f'\nNonexistent key: {choice}')
                 print('You can select a key with the arrows, tab, Ctrl+r, etc. '
@@ -276,13 +545,49 @@ class Nest:
             readline.clear_history()
 
 
+def get_item(obj, key):
+    """Return the element of obj at key, which can be a path like "a 0 b"."""
+    if isinstance(obj, list):
+        if isinstance(key, int):
+            return obj[key]
+
+        try:
+            head, rest = split_key(key)
+            item = obj[int(head)]
+            return get_item(item, rest) if rest else item
+        except ValueError:
+            raise KeyError(key)
+    elif isinstance(obj, dict):
+        if key in obj:
+            # In the unlikely case that we have a key with whitespace.
+            return obj[key]
+
+        try:
+            head, rest = split_key(key)
+            item = obj[head]
+            return get_item(item, rest) if rest else item
+        except (ValueError, KeyError):
+            raise KeyError(key)
+    else:
+        return obj[key]
+
+
+@functools.lru_cache(maxsize=1024)
+def split_key(key):
+    """Return the first part of a key path and the rest ("a 0 b" -> a, 0 b)."""
+    head, *rest = key.split(None, 1)
+    return head, (rest[0] if rest else None)
+
+
 def wrap(x):
     """Return object x, but "wrapped" as Nest if it makes sense."""
-    return Nest(x) if type(x) in [dict, list] else x
+    return Nest(x) if isinstance(x, (dict, list)) else x
 
 
 def readline_init():
     """Initialize readline."""
+    import readline
+
     readline.parse_and_bind('tab: complete')
     readline.parse_and_bind('set show-all-if-ambiguous on')
 
@@ -291,11 +596,24 @@ def readline_init():
 
 
 def readline_set_completer(names):
-    for name in names:
-        readline.add_history(name)  # so one can scroll and search them
+    import readline
+
+    if len(names) <= 1000:  # more would be slow to add, and hardly useful
+        for name in names:
+            readline.add_history(name)  # so one can scroll and search them
+
+    lowered = [(name, name.lower()) for name in names]  # lowercase only once
+
+    # Readline calls completer with the same text and state=0,1,2...
+    # so we compute the matches only when the text changes.
+    last_text, matches = None, []
 
     def completer(text, state):
-        matches = [name for name in names if text.lower() in name.lower()]
+        nonlocal last_text, matches
+        if text != last_text:
+            text_lower = text.lower()
+            last_text = text
+            matches = [name for name, lower in lowered if text_lower in lower]
         return matches[state] if state < len(matches) else None
 
     readline.set_completer(completer)
@@ -304,53 +622,182 @@ def readline_set_completer(names):
 def read_xml(xml):
     """Return the given xml string(s) as a python object."""
     # Used to read a typical Entrez response, which can have several xmls.
-    xml_str = xml if type(xml) == str else '\n'.join(xml)
+    # We feed the lines to the parser as they come, so we never need to
+    # join them all in a big string.
+    lines = xml.split('\n') if isinstance(xml, str) else xml
+
+    # The parser builds the python object directly (with DictBuilder),
+    # without making an intermediate tree of xml nodes.
+    obj = []
+    parser = xml_parser(target=DictBuilder())
+    block = []  # lines to feed together to the parser (faster than one by one)
+    for i, line in enumerate(lines):
+        if i > 0 and line.startswith('<?xml'):  # a new xml document starts
+            parser.feed(''.join(block))
+            obj.append(parser.close())
+            parser, block = xml_parser(target=DictBuilder()), []
+
+        block.append(line + '\n')
+
+        if len(block) == 1000:
+            parser.feed(''.join(block))
+            block = []
+    parser.feed(''.join(block))
+    obj.append(parser.close())
 
-    # Separate all xmls (even if typically there is only one).
-    xmls = []
-    start, end = 0, xml_str.find('\n<?xml')
-    while end != -1:
-        xmls.append(xml_str[start:end])
-        start, end = end + 1, xml_str.find('\n<?xml', end + 1)
-    xmls.append(xml_str[start:])
-
-    obj = [xml_node_to_dict(ElementTree.XML(x)) for x in xmls]
     return Nest(obj[0] if len(obj) == 1 else obj)
 
 
-def xml_node_to_dict(node):
-    """Return a dict with the contents of the given xml node."""
-    # If the node has attributes, we'll keep them with a "@" in front.
-    subdict = {'@'+k: v for k, v in node.attrib.items()}
+def xml_parser(target=None):
+    """Return a parser to feed xml, that returns the result of target on close.
+
+    If no target is given, the result is the root node of the xml tree.
+    """
+    if lxml_etree is None:
+        return ElementTree.XMLParser(target=target)
+
+    # Same kind of tree that ElementTree would give us (no comments, etc.).
+    return lxml_etree.XMLParser(target=target, remove_comments=True,
+                                remove_pis=True, huge_tree=True)
+
+
+class DictBuilder:
+    """Target for an xml parser, to build the python object of the xml.
+
+    It gives the same result as xml_node_to_dict() on the xml root node.
+    """
+    def __init__(self):
+        self.stack = []  # (tag, attrib, text pieces, converted children)
+        self.result = None
+
+    def start(self, tag, attrib):
+        self.stack.append((tag, attrib, [], []))
 
-    tag = node.tag
-    tags = [n.tag for n in node]  # all tags in children nodes
-    ntags = len(set(tags))  # number of different tags in children
+    def data(self, text):
+        if self.stack:
+            _, _, texts, converted = self.stack[-1]
+            if not converted:  # only the text before the children counts
+                texts.append(text)
 
-    if len(tags) == 0:  # no children -> add its text
-        if len(subdict) == 0:
-            return {tag: node.text or ''}
+    def end(self, tag):
+        tag, attrib, texts, converted = self.stack.pop()
+
+        result = make_dict(tag, attrib, ''.join(texts), converted)
+
+        if self.stack:
+            self.stack[-1][3].append(result)  # add to its parent's converted
         else:
-            return {tag: dict(subdict, text=(node.text or ''))}
-    elif len(tags) == ntags:  # all tags are different -> add a dict
-        for n in node:
-            subdict.update(xml_node_to_dict(n))  # add content from subnodes
+            self.result = result
+
+    def close(self):
+        return self.result
+
+
+def xml_stream(xml, tag):
+    """Yield as python objects the elements with the given tag in xml.
+
+    Like read_xml(), but the xml string(s) are parsed incrementally, and
+    each element is freed once converted, so the whole response is
+    never kept in memory. Useful for big responses, with many
+    elements of the same kind (like the DocSum of a summary).
+    """
+    lines = xml.split('\n') if isinstance(xml, str) else xml
+
+    depth = 0  # number of open elements with the given tag
+
+    def convert(events):
+        """Yield dicts for the outermost elements with the given tag."""
+        nonlocal depth
+        for event, node in events:
+            if node.tag == tag:
+                if event == 'start':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:  # (inner ones are part of it)
+                        yield xml_node_to_dict(node)
+                        node.clear()  # free its memory, we are done with it
+
+    parser = None
+    for line in lines:
+        if parser is None or line.startswith('<?xml'):  # new xml document
+            if parser is not None:
+                parser.close()
+                yield from convert(parser.read_events())
+            parser = ElementTree.XMLPullParser(events=('start', 'end'))
+            depth = 0
+
+        parser.feed(line + '\n')
+        yield from convert(parser.read_events())
+
+    if parser is not None:
+        parser.close()
+        yield from convert(parser.read_events())
+
+
+def xml_node_to_dict(root):
+    """Return a dict with the contents of the given xml node."""
+    # We go through the nodes in post-order with an explicit stack
+    # (instead of recursion), converting each node once all its children
+    # are converted. Deep xmls don't hit the recursion limit this way.
+    stack = [(root, iter(root), [])]  # (node, its children, their dicts)
+    while True:
+        node, children, converted = stack[-1]
+
+        child = next(children, None)
+        if child is not None:
+            stack.append((child, iter(child), []))  # convert child first
+            continue
+
+        stack.pop()
+        result = node_to_dict(node, converted)
+
+        if not stack:
+            return result
+
+        stack[-1][2].append(result)  # add it to its parent's converted
+
+
+def node_to_dict(node, converted):
+    """Return a dict for xml node, given its already converted children."""
+    return make_dict(node.tag, node.attrib, node.text or '', converted)
+
+
+def make_dict(tag, attrib, text, converted):
+    """Return a dict for an xml node with the given contents."""
+    # If the node has attributes, we'll keep them with a "@" in front.
+    subdict = {'@'+k: v for k, v in attrib.items()} if attrib else {}
+
+    if not converted:  # no children -> add its text
+        if not subdict:
+            return {tag: text}
+        subdict['text'] = text
         return {tag: subdict}
-    elif ntags == 1:  # all tags are the same -> add a list
-        if len(subdict) == 0:
-            return {tag: [xml_node_to_dict(n) for n in node]}
-        else:
-            return {tag: dict(subdict,
-                              children=[xml_node_to_dict(n) for n in node])}
-    else:  # some tags are the same and others aren't... what the heck
-        nodes = sorted((n for n in node), key=lambda n: n.tag)
 
-        for gtag, group_tag in groupby(nodes, lambda n: n.tag):
-            nodes_tag = list(group_tag)  # don't exhaust the iterator
+    # Count the converted children of each tag, in one pass.
+    counts = {}  # tag -> number of converted children with that tag
+    for child in converted:
+        ctag, = child  # each converted child is a dict {tag: content}
+        counts[ctag] = counts.get(ctag, 0) + 1
 
-            if len(nodes_tag) == 1:
-                subdict.update(xml_node_to_dict(nodes_tag[0]))
+    if len(counts) == len(converted):  # all tags are different -> add a dict
+        for child in converted:
+            subdict.update(child)  # add content from subnodes
+        return {tag: subdict}
+    elif len(counts) == 1:  # all tags are the same -> add a list
+        if not subdict:
+            return {tag: converted}
+        subdict['children'] = converted
+        return {tag: subdict}
+    else:  # some tags are the same and others aren't... what the heck
+        groups = {gtag: [] for gtag in sorted(counts)}  # for a consistent order
+        for child in converted:
+            ctag, = child
+            groups[ctag].append(child)
+
+        for gtag, group in groups.items():
+            if len(group) == 1:
+                subdict.update(group[0])
             else:
-                subdict.update({(gtag+'-group'):
-                                [xml_node_to_dict(n) for n in nodes_tag]})
+                subdict[gtag+'-group'] = group
         return {tag: subdict}
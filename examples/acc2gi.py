@@ -6,13 +6,29 @@ numbers, or the ones that can be extracted from some fasta files.
 """
 
 import sys
+import os
 import re
+import mmap
 import argparse
+import shelve
+from urllib.parse import quote_plus
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path += ['.', '..']
 import entrez
 
 
+# Characters that can follow the prefixes of some accession numbers.
+_DIGITS = set('0123456789')
+_UPPER_DIGITS = _DIGITS | set('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+# Databases that appear before the accession number in an "Extra" item.
+_ACC_DBS = ('emb', 'gb', 'ref', 'dbj')
+
+_ACCN = quote_plus('[accn]')  # url-encoded search field for accession numbers
+
+
 def main():
     args = get_args()
 
@@ -25,12 +41,34 @@ def main():
 
     # Get accessions from the given list if given, or from the given files.
     accessions = args.accessions or read_accessions(args.fastas)
+    if args.max >= 0:
+        accessions = accessions[:args.max]
 
-    # Print the GIs and accession numbers for all accession numbers,
-    # in groups of args.nreq numbers per request to the NCBI webservers.
-    total_requests = args.max if args.max >= 0 else len(accessions)
-    for i in range(0, total_requests, args.nreq):
-        print_acc2gi(accessions[i:min(i + args.nreq, total_requests)])
+    with open_cache(None if args.no_cache else args.cache) as cache:
+        # Print first the ones that we already know.
+        misses = []
+        for a in accessions:
+            if a in cache:
+                print('%18s  ->  %s' % cache[a])
+            else:
+                misses.append(a)
+
+        # Print the GIs and accession numbers for the rest, in groups of
+        # args.nreq numbers per request to the NCBI webservers. The
+        # requests are made concurrently (entrez keeps them within the
+        # allowed rate), and the results are printed in order.
+        batches = [misses[i:i + args.nreq]
+                   for i in range(0, len(misses), args.nreq)]
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            for results in executor.map(acc2gi, batches):
+                for a, acc, gi in results:
+                    print('%18s  ->  %s' % (acc, gi))
+                    cache[a] = (acc, gi)
+
+    if accessions and not args.no_cache:
+        print('Found in cache: %d of %d (%.0f%%)' %
+              (len(accessions) - len(misses), len(accessions),
+               100 * (1 - len(misses) / len(accessions))), file=sys.stderr)
 
 
 def get_args():
@@ -46,34 +84,107 @@ def get_args():
                         help='number of accession numbers per request')
     parser.add_argument('-m', '--max', type=int, default=-1,
                         help='maximum number to query')
+    parser.add_argument('-t', '--threads', type=int, default=8,
+                        help='number of requests to make concurrently')
     parser.add_argument('-c', '--check', action='store_true',
                         help='just check duplicate accession numbers')
+    parser.add_argument('--cache', metavar='FILE',
+                        default=os.path.expanduser('~/.cache/acc2gi.db'),
+                        help='file with the already known GIs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not read or write the cache')
 
     return parser.parse_args()
 
 
-def print_acc2gi(accessions):
-    """Print GIs corresponding to the given accession numbers."""
-    term = ' OR '.join(a + '[accn]' for a in accessions)
-    for line in entrez.on_search(term=term, db='nucleotide', tool='summary'):
-        if 'Name="Extra"' in line and any(a in line for a in accessions):
-            gi = re.search('gi\|([0-9]+)\|', line).group(1)
-            acc = re.search('((emb)|(gb)|(ref)|(dbj))\|(?P<acc>\w+\.[0-9]+)\|',
-                            line).group('acc')
-            print('%18s  ->  %s' % (acc, gi))
+def acc2gi(accessions):
+    """Return list of (accession, full accession, GI) for the given ones."""
+    # Search term "acc1[accn] OR acc2[accn] OR ...", already url-encoded.
+    raw_term = '&term=' + '+OR+'.join(quote_plus(a) + _ACCN for a in accessions)
+    # The accession numbers as they appear in "...|ref|NC_010611.1|...".
+    matcher = re.compile(r'\|(%s)(?:\.\d+)?\|' %
+                         '|'.join(re.escape(a) for a in accessions))
+    results = []
+    selections = entrez.select(tool='search', db='nucleotide',
+                               raw_params=raw_term)
+    for line in entrez.apply(tool='summary', db='nucleotide',
+                             selections=selections):
+        match = matcher.search(line) if 'Name="Extra"' in line else None
+        if match:
+            gi, acc = extract_gi_acc(line)
+            results.append((match.group(1), acc, gi))
+    return results
+
+
+def extract_gi_acc(line):
+    """Return the GI and accession number that appear in the given line."""
+    # The line looks like:  ...>gi|184156320|ref|NC_010611.1|[184156320]<...
+    parts = line.split('|')
+    fields = range(len(parts) - 2)  # the values must be followed by a '|'
+    gi = next(parts[i+1] for i in fields if parts[i].endswith('gi'))
+    acc = next(parts[i+1] for i in fields if parts[i].endswith(_ACC_DBS))
+    return gi, acc
+
+
+@contextmanager
+def open_cache(fname):
+    """Yield a dict-like object with the GIs stored in file fname."""
+    if not fname:
+        yield {}  # no persistent cache
+        return
+
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None  # not available (on Windows), so we do not lock
+
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    with open(fname + '.lock', 'w') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # in case of concurrent runs
+        with shelve.open(fname) as cache:
+            yield cache
 
 
 def read_accessions(fnames):
     """Return a list of accession numbers from a list of fasta files."""
     accessions = []
     for fname in fnames:
-        for line in open(fname):
-            if line.startswith('>'):  # header with the accession number info
-                raw = line.strip('> \n').split(' ', 1)[0]  # take the beginning
-                accessions.append(parse(raw))
+        for header in read_headers(fname):  # with the accession number info
+            raw = header.strip(b'> \r').split(b' ', 1)[0]  # take the beginning
+            accessions.append(parse(raw.decode()))
     return accessions
 
 
+def read_headers(fname):
+    """Yield the header lines (as bytes, without newline) of a fasta file."""
+    # Jump from header to header, instead of going through all the lines
+    # of the sequences (which are most of the file) only to discard them.
+    # The file is memory-mapped, so even huge files are not read in full.
+    with open(fname, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return  # empty file (and mmap cannot map it)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[:1] == b'>':
+                start = 0  # position of the first header
+            else:
+                start = buf.find(b'\n>') + 1
+                if start == 0:
+                    return  # no headers
+
+            while True:
+                end = buf.find(b'\n', start)
+                if end == -1:
+                    end = len(buf)
+
+                yield buf[start:end]  # the caller decodes what it needs
+
+                start = buf.find(b'\n>', end) + 1
+                if start == 0:
+                    return  # no more headers
+
+
 def parse(raw):
     """Return the accession number contained in the raw string of a fasta."""
     # A quite sui-generis parser to get the accession numbers.
@@ -84,15 +195,19 @@ def parse(raw):
     #   2:1314_M29695.1                ->  M29695.1
     #   (Tmt)DfrB4:FM87748469-305:237  ->  FM87748469
 
-    if re.search('NC_\d+', raw):            # Eg: NC_013773
-        return re.search('NC_\d+', raw).group()
-    elif re.search('NZ_[A-Z0-9]+', raw):    # Eg: NZ_AGSO01000004.1
-        return re.search('NZ_[A-Z0-9]+', raw).group()
-    elif '_' in raw:             # Eg: VanY-D_4_AY489045, dfrB3_1_FM877478
-        return raw.split('_')[-1]
-    elif re.search('.orf\d*.gene$', raw):   # Eg: EU177504.2.orf0.gene
-        return raw.split('.orf')[0]
-    elif re.search('.gene\d*$', raw):       # Eg: AY139592.1.gene4
+    nc = find_prefixed(raw, 'NC_', _DIGITS)
+    if nc:                                  # Eg: NC_013773
+        return nc
+
+    nz = find_prefixed(raw, 'NZ_', _UPPER_DIGITS)
+    if nz:                                  # Eg: NZ_AGSO01000004.1
+        return nz
+
+    if '_' in raw:               # Eg: VanY-D_4_AY489045, dfrB3_1_FM877478
+        return raw.rsplit('_', 1)[-1]
+    elif raw.endswith('.gene') and ends_with_numbered(raw[:-5], '.orf'):
+        return raw.split('.orf')[0]         # Eg: EU177504.2.orf0.gene
+    elif ends_with_numbered(raw, '.gene'):  # Eg: AY139592.1.gene4
         return raw.split('.gene')[0]
     elif ':' in raw:                        # Eg: (Tmt)DfrB4:FM87748469-305:237
         return raw.split(':')[1].split('-')[0]
@@ -100,25 +215,48 @@ def parse(raw):
         raise RuntimeError('Do not know how to parse: %s' % raw)
 
 
+def find_prefixed(text, prefix, chars):
+    """Return first prefix in text followed by some of the chars, or None."""
+    # Same as  re.search(prefix + '[chars]+', text)  but much faster.
+    start = text.find(prefix)
+    while start != -1:
+        end = start + len(prefix)
+        while end < len(text) and text[end] in chars:
+            end += 1
+
+        if end > start + len(prefix):
+            return text[start:end]
+
+        start = text.find(prefix, start + 1)
+
+    return None
+
+
+def ends_with_numbered(text, word):
+    """Return True if text ends with word followed by only digits (if any)."""
+    # Same as  re.search(re.escape(word) + r'\d*$', text)  but much faster.
+    pos = text.rfind(word)
+    return pos != -1 and all(c in _DIGITS for c in text[pos + len(word):])
+
+
 def print_duplicates(fnames):
     """Print information about duplicate accession numbers in files."""
-    full_names = []
-    for fname in fnames:
-        for line in open(fname):
-            if line.startswith('>'):
-                full_names.append(line.split()[0].strip('>'))
+    # For each accession number, position and full name where it was first
+    # seen. We only keep those, not the full names of all the headers.
+    seen = {}
 
-    seen = {}  # dict, for each accession number says where it was first seen
-    for i, name in enumerate(full_names):
+    headers = (h for fname in fnames for h in read_headers(fname))
+    for current, header in enumerate(headers):
+        name = header.split()[0].strip(b'>').decode()
         acc = parse(name)
         if acc not in seen:
-            seen[acc] = i
+            seen[acc] = (current, name)
         else:
-            first, current = seen[acc], i
+            first, first_name = seen[acc]
             print('* Accession number %s at position %d was first seen at %d:'
                   % (acc, current + 1, first + 1))
-            print('  %6d - %s' % (first, full_names[first]))
-            print('  %6d - %s' % (current, full_names[current]))
+            print('  %6d - %s' % (first, first_name))
+            print('  %6d - %s' % (current, name))
 
 
 
@@ -5,7 +5,14 @@ Run with our interface the sample applications of the E-utilities
 that appear in https://www.ncbi.nlm.nih.gov/books/NBK25498
 """
 
+import os
+import re
 import sys
+import argparse
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
 
 sys.path += ['.', '..']
 import entrez as ez
@@ -15,6 +22,50 @@ import entrez as ez
 # translated in a straighforward way. For a slightly better way of
 # doing the same thing, see the notes at the end of this file.
 
+def print_lines(lines):
+    """Print the given lines, faster than calling print() for each one."""
+    sys.stdout.writelines(line + '\n' for line in lines)
+
+
+def in_background(lines):
+    """Return an iterator over lines, which are read in a background thread.
+
+    We use it to download a response while we print another one. The
+    lines are kept in memory until consumed, so it can be the whole
+    response. The reading stops if the iterator is closed, and never
+    keeps the program from exiting (the thread is a daemon).
+    """
+    queue = Queue()  # lines read, then end (or the exception that stopped us)
+    end = object()
+    stop = threading.Event()  # set when nobody wants more lines
+
+    def read():
+        try:
+            for line in lines:
+                if stop.is_set():
+                    return
+                queue.put(line)
+            queue.put(end)
+        except Exception as e:
+            queue.put(e)
+
+    threading.Thread(target=read, daemon=True).start()  # reads right now
+
+    def results():
+        try:
+            while True:
+                line = queue.get()
+                if line is end:
+                    return
+                elif isinstance(line, Exception):
+                    raise line
+                yield line
+        finally:
+            stop.set()
+
+    return results()
+
+
 def sample_1():
     """ESearch - ESummary/EFetch
 
@@ -27,14 +78,16 @@ def sample_1():
     # Select the elements: query pubmed and keep the reference.
     selections = ez.select(tool='search', db='pubmed', term=query)
 
+    # Formatted data records (abstracts in this case).
+    # (Downloaded in the background while we print the summaries.)
+    records = in_background(
+        ez.apply(tool='fetch', db='pubmed', selections=selections,
+                 rettype='abstract'))
+
     # XML document summaries.
-    for line in ez.apply(tool='summary', db='pubmed', selections=selections):
-        print(line)
+    print_lines(ez.apply(tool='summary', db='pubmed', selections=selections))
 
-    # Formatted data records (abstracts in this case).
-    for line in ez.apply(tool='fetch', db='pubmed', selections=selections,
-                         rettype='abstract'):
-        print(line)
+    print_lines(records)
 
 
 def sample_2():
@@ -47,14 +100,16 @@ def sample_2():
 
     selections = ez.select(tool='post', db='protein', id=id_list)
 
+    # Formatted data records (FASTA in this case).
+    # (Downloaded in the background while we print the summaries.)
+    records = in_background(
+        ez.apply(tool='fetch', db='protein', selections=selections,
+                 rettype='fasta'))
+
     # XML document summaries.
-    for line in ez.apply(tool='summary', db='protein', selections=selections):
-        print(line)
+    print_lines(ez.apply(tool='summary', db='protein', selections=selections))
 
-    # Formatted data records (FASTA in this case).
-    for line in ez.apply(tool='fetch', db='protein', selections=selections,
-                         rettype='fasta'):
-        print(line)
+    print_lines(records)
 
 
 def sample_3():
@@ -71,14 +126,16 @@ def sample_3():
                            id=id_list, linkname='protein_gene',
                            cmd='neighbor_history')
 
+    # Formatted data records of selected genes (FASTA in this case).
+    # (Downloaded in the background while we print the summaries.)
+    records = in_background(
+        ez.apply(tool='fetch', db='gene', selections=selections,
+                 rettype='fasta'))
+
     # XML document summaries of selected genes.
-    for line in ez.apply(tool='summary', db='gene', selections=selections):
-        print(line)
+    print_lines(ez.apply(tool='summary', db='gene', selections=selections))
 
-    # Formatted data records of selected genes (FASTA in this case).
-    for line in ez.apply(tool='fetch', db='gene', selections=selections,
-                         rettype='fasta'):
-        print(line)
+    print_lines(records)
 
 
 def sample_4():
@@ -96,14 +153,16 @@ def sample_4():
                        previous=s_pubmed, linkname='pubmed_protein',
                        cmd='neighbor_history')
 
+    # Formatted data records of selected proteins (FASTA in this case).
+    # (Downloaded in the background while we print the summaries.)
+    records = in_background(
+        ez.apply(tool='fetch', db='protein', selections=s_prot,
+                 rettype='fasta'))
+
     # Linked XML Document Summaries from database protein.
-    for line in ez.apply(tool='summary', db='protein', selections=s_prot):
-        print(line)
+    print_lines(ez.apply(tool='summary', db='protein', selections=s_prot))
 
-    # Formatted data records of selected proteins (FASTA in this case).
-    for line in ez.apply(tool='fetch', db='protein', selections=s_prot,
-                         rettype='fasta'):
-        print(line)
+    print_lines(records)
 
 
 def sample_5():
@@ -121,12 +180,14 @@ def sample_5():
                        previous=s_prot, linkname='protein_gene',
                        cmd='neighbor_history')
 
-    for line in ez.apply(tool='summary', db='gene', selections=s_gene):
-        print(line)
+    # (Downloaded in the background while we print the summaries.)
+    records = in_background(
+        ez.apply(tool='fetch', db='gene', selections=s_gene,
+                 rettype='xml', retmode='xml'))
+
+    print_lines(ez.apply(tool='summary', db='gene', selections=s_gene))
 
-    for line in ez.apply(tool='fetch', db='gene', selections=s_gene,
-                         rettype='xml', retmode='xml'):
-        print(line)
+    print_lines(records)
 
 
 def sample_6():
@@ -140,9 +201,8 @@ def sample_6():
 
     selections = ez.select(tool='post', db='protein', id=id_list)
 
-    for line in ez.apply(tool='search', db='protein', term='human[orgn]',
-                         selections=selections):
-        print(line)
+    print_lines(ez.apply(tool='search', db='protein', term='human[orgn]',
+                         selections=selections))
 
 # The way it is done in the original example, it would look like:
 #    query = '#%s AND human[orgn]' % selections['QueryKey']
@@ -168,9 +228,8 @@ def sample_7():
                            cmd='neighbor_history')
 
     query = 'human[orgn] AND x[chr]'
-    for line in ez.apply(tool='search', db='gene', term=query,
-                         selections=selections):
-        print(line)
+    print_lines(ez.apply(tool='search', db='gene', term=query,
+                         selections=selections))
 
 
 def application_1():
@@ -182,9 +241,8 @@ def application_1():
     # Input: comma-delimited list of GI numbers.
     gi_list = '24475906,224465210,50978625,9507198'
 
-    for line in ez.query(tool='fetch', db='nucleotide',
-                         id=gi_list, rettype='acc'):
-        print(line)
+    print_lines(ez.query(tool='fetch', db='nucleotide',
+                         id=gi_list, rettype='acc'))
 
     # The order of the accessions in the output will be the same order as the
     # GI numbers in gi_list.
@@ -201,9 +259,8 @@ def application_2():
     query = ' OR '.join(a + '[accn]' for a in accs)
 
     # Output: FASTA data.
-    for line in ez.on_search(term=query, db='nuccore',
-                             tool='fetch', rettype='fasta'):
-        print(line)
+    print_lines(ez.on_search(term=query, db='nuccore',
+                             tool='fetch', rettype='fasta'))
 
 
 def application_3():
@@ -212,10 +269,10 @@ def application_3():
     Download all chimpanzee mRNA sequences in FASTA format (>50,000 sequences).
     """
     query = 'chimpanzee[orgn] AND biomol mrna[prop]'
-    with open('chimp.fna', 'w') as fout:
-        for line in ez.on_search(term=query, db='nucleotide',
-                                 tool='fetch', rettype='fasta'):
-            fout.write(line + '\n')
+    lines = ez.on_search(term=query, db='nucleotide',
+                         tool='fetch', rettype='fasta')
+    with open('chimp.fna', 'w', buffering=1024*1024) as fout:
+        fout.writelines(line + '\n' for line in lines)
     print('The results are in file chimp.fna.')
 
 
@@ -226,31 +283,37 @@ def application_4():
     on human chromosome 20.
     """
     query = 'human[orgn] AND 20[chr] AND alive[prop]'
+    id_regexp = re.compile(r'<Id>(\d+)</Id>')  # like:  <Id>6714</Id>
     ids = []
     for line in ez.query(tool='search', db='gene', term=query,
                          usehistory='y', retmax=5000):
-        if line.strip().startswith('<Id>'):  # like:  <Id>6714</Id>
-            ids.append(line.split('>')[1].split('<')[0])
-
-    raw_params = ''.join('&id=%s' % x for x in ids)
-    with open('snp_table', 'w') as fout:
-        in_idlist = False
-        links = []
-        for line in ez.query(tool='link', raw_params=raw_params,
-                             dbfrom='gene', db='snp', linkname='gene_snp'):
-            if '<IdList>' in line:
-                in_idlist = True
-            if '</IdList>' in line:
-                in_idlist = False
-            if '</LinkSet>' in line:
-                fout.write(','.join(links) + '\n')
-                links = []
-            if '<Id>' in line:
-                gid = line.split('<Id>')[1].split('</Id>')[0]
-                if in_idlist:
-                    fout.write('%s:' % gid)
-                else:
-                    links.append(gid)
+        ids.extend(id_regexp.findall(line))
+    ids = list(dict.fromkeys(ids))  # without repetitions (but in order)
+
+    def get_links(genes):  # lines of the response to the link query for genes
+        raw_params = '&id=' + '&id='.join(genes)
+        return list(ez.query(tool='link', raw_params=raw_params,
+                             dbfrom='gene', db='snp', linkname='gene_snp'))
+
+    # Ask for the links of several batches of genes at the same time (the
+    # entrez module takes care of not exceeding the requests per second).
+    batch_size = 200  # number of genes we ask about in each link query
+    batches = [ids[i:i+batch_size] for i in range(0, len(ids), batch_size)]
+    nworkers = 10 if ez.API_KEY else 3  # as many as requests per second
+    with open('snp_table', 'w', buffering=1024*1024) as fout, \
+         ThreadPoolExecutor(nworkers) as executor:
+        for lines in executor.map(get_links, batches):  # in order
+            # Parse the xml as it goes, writing each gene with its snps.
+            parser = ElementTree.XMLPullParser(events=('end',))
+            for line in lines:
+                parser.feed(line + '\n')
+                for _, node in parser.read_events():
+                    if node.tag == 'LinkSet':
+                        gene = node.findtext('IdList/Id')
+                        snps = [x.text for x in
+                                node.iterfind('LinkSetDb/Link/Id')]
+                        fout.write('%s:%s\n' % (gene, ','.join(snps)))
+                        node.clear()  # free its memory, we are done with it
     print('The results are in file snp_table.')
 
 # Note that (since at least 2016 and as of Oct 2023) there is a
@@ -261,27 +324,58 @@ def application_4():
 
 
 
-if __name__ == '__main__':
-    # Let the user choose which sample to run.
-    print('Examples from https://www.ncbi.nlm.nih.gov/books/NBK25498/')
+def main():
     functions = [
         sample_1, sample_2, sample_3, sample_4, sample_5, sample_6, sample_7,
         application_1, application_2, application_3, application_4]
-    docs = [f.__doc__ for f in functions]  # docstrings
+
+    parser = argparse.ArgumentParser(description=__doc__, epilog=(
+        'If the environment variable NCBI_API_KEY is set, its value is used '
+        'as the api key for all the queries.'))
+    parser.add_argument('sample', type=int, nargs='?',
+                        choices=range(1, len(functions) + 1), metavar='N',
+                        help='sample to run (if not given, choose from a menu)')
+    parser.add_argument('--all', action='store_true',
+                        help='run all the samples, one after the other')
+    args = parser.parse_args()
+
+    # With an api key we can make more requests per second (10 instead of 3).
+    ez.API_KEY = os.environ.get('NCBI_API_KEY') or ez.API_KEY
+
+    if args.sample:  # run it directly
+        functions[args.sample - 1]()
+        return
+
+    if args.all:
+        for function in functions:
+            print('\n# %s' % function.__doc__.split('\n', 1)[0])
+            function()
+        return
+
+    # Let the user choose which sample to run.
+    print('Examples from https://www.ncbi.nlm.nih.gov/books/NBK25498/')
+    menu = '\n'.join('  %3d - %s' % (i, f.__doc__.split('\n', 1)[0])
+                     for i, f in enumerate(functions, 1))
+    choices = {str(i): f for i, f in enumerate(functions, 1)}
 
     while True:
-        for i in range(len(functions)):
-            print('  %3d - %s' % (i + 1, docs[i].splitlines()[0]))
+        print(menu)
         try:
-            choice = int(input('Sample to run: ')) - 1
-            assert 0 <= choice < len(functions)
-        except (ValueError, AssertionError, KeyboardInterrupt, EOFError):
+            function = choices.get(input('Sample to run: ').strip())
+        except (KeyboardInterrupt, EOFError):
+            function = None
+
+        if function is None:
             print('\nBye!')
             break
 
-        print(docs[choice])
+        print(function.__doc__)
         print('Running...')
-        functions[choice]()
+        function()
+
+
+if __name__ == '__main__':
+    main()
 
 
 # We could do some of the examples in an easier way. For example...
@@ -300,7 +394,9 @@ if __name__ == '__main__':
 # by using on_search twice, we call 'search' two times instead
 # of calling it once and keeping the resulting QueryKey and WebEnv
 # for future queries. In many cases (as in these examples), you
-# pay very little for that.
+# pay very little for that. When you do (a slow search, or many tools
+# over its results), keep the selections as sample_1() does: all the
+# calls to apply() with them reuse the same search on the NCBI servers.
 #
 # For sample_2():
 #
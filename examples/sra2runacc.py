@@ -15,7 +15,7 @@ the different samples in the SRA study.
 
 import sys
 import argparse
-import re
+from xml.etree import ElementTree
 
 sys.path += ['.', '..']
 import entrez as ez
@@ -26,10 +26,15 @@ def main():
     parser.add_argument('sra', metavar='SRAid', help='SRA identifier')
     args = parser.parse_args()
 
-    for line in ez.on_search(db='sra', term=args.sra, tool='summary'):
-        if 'Name="Runs"' in line:
-            acc = re.search('acc=\"(?P<acc>\w+[0-9]+)\"', line).group('acc')
-            print(acc)
+    # The summary comes as xml, with an item for the runs of each
+    # experiment (which has the runs as escaped xml too), like:
+    #   <Item Name="Runs" Type="String">&lt;Run acc="SRR390728" .../&gt;</Item>
+    lines = ez.on_search(db='sra', term=args.sra, tool='summary')
+    for item in ez.xml_stream(lines, 'Item'):
+        if item['Item'].get('@Name') == 'Runs':
+            runs = ElementTree.XML('<Runs>%s</Runs>' % item['Item']['text'])
+            for run in runs:
+                print(run.get('acc'))
 
 
 
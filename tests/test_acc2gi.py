@@ -0,0 +1,44 @@
+import sys
+import re
+import random
+
+sys.path += ['examples', '../examples']
+import acc2gi
+
+import pytest
+
+
+def test_parse():
+    # The examples in the comments of parse(), and some more.
+    assert acc2gi.parse('X64695.1.gene9') == 'X64695.1'
+    assert acc2gi.parse('VanY-D_4_AY489045') == 'AY489045'
+    assert acc2gi.parse('2:1314_M29695.1') == 'M29695.1'
+    assert acc2gi.parse('(Tmt)DfrB4:FM87748469-305:237') == 'FM87748469'
+    assert acc2gi.parse('NC_013773') == 'NC_013773'
+    assert acc2gi.parse('x|NZ_AGSO01000004.1') == 'NZ_AGSO01000004'
+    assert acc2gi.parse('dfrB3_1_FM877478') == 'FM877478'
+    assert acc2gi.parse('EU177504.2.orf0.gene') == 'EU177504.2'
+    assert acc2gi.parse('AY139592.1.gene4') == 'AY139592.1'
+
+    # Without a real "." before "gene" or "orf", they are not recognized.
+    for raw in ['Agene', 'ABCorf1Xgene', 'AY139592']:
+        with pytest.raises(RuntimeError):
+            acc2gi.parse(raw)
+
+
+def test_parse_helpers():
+    # The string-method helpers do the same as the regexps they replace.
+    rng = random.Random(0)
+    for _ in range(5000):
+        text = ''.join(rng.choice('NCZ_.genorf0123AB') for _ in range(12))
+
+        match = re.search('NC_[0-9]+', text)
+        assert acc2gi.find_prefixed(text, 'NC_', acc2gi._DIGITS) == (
+            match.group() if match else None)
+
+        match = re.search('NZ_[A-Z0-9]+', text)
+        assert acc2gi.find_prefixed(text, 'NZ_', acc2gi._UPPER_DIGITS) == (
+            match.group() if match else None)
+
+        assert acc2gi.ends_with_numbered(text, '.gene') == bool(
+            re.search(r'\.gene[0-9]*$', text))
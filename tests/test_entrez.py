@@ -1,4 +1,8 @@
+import io
 import sys
+import gzip
+
+import pytest
 
 sys.path += ['.', '..']
 import entrez as ez
@@ -54,3 +58,135 @@ def test_on_search():
         {'@Name': 'ReplacedBy', '@Type': 'String', 'text': ''},
         {'@Name': 'Comment', '@Type': 'String', 'text': '  '},
         {'@Name': 'AccessionVersion', '@Type': 'String', 'text': 'NC_010611.1'}]
+
+
+def test_read_xml():
+    xml = """<?xml version="1.0" encoding="UTF-8" ?>
+<Result>
+  <Count>2</Count>
+  <IdList>
+    <Id>10</Id>
+    <Id>20</Id>
+  </IdList>
+  <Doc Type="x">
+    <Item Name="a">A</Item>
+    <Item Name="b">B</Item>
+    <Title>t</Title>
+  </Doc>
+</Result>"""
+    data = ez.read_xml(xml)
+
+    assert data == {'Result': {
+        'Count': '2',
+        'IdList': [{'Id': '10'}, {'Id': '20'}],
+        'Doc': {'@Type': 'x',
+                'Item-group': [{'Item': {'@Name': 'a', 'text': 'A'}},
+                               {'Item': {'@Name': 'b', 'text': 'B'}}],
+                'Title': 't'}}}
+
+    assert data['Result IdList 1 Id'] == '20'
+
+
+def test_xml_stream():
+    xml = ('<?xml version="1.0"?>\n'
+           '<DocSum>\n'
+           '  <Item Type="List"><Item>X</Item><Item>Y</Item></Item>\n'
+           '  <Item>a\u2028b</Item>\n'
+           '</DocSum>')
+
+    assert list(ez.xml_stream(xml, 'Item')) == [
+        {'Item': {'@Type': 'List', 'children': [{'Item': 'X'},
+                                                {'Item': 'Y'}]}},
+        {'Item': 'a\u2028b'}]
+
+
+# Offline tests of the lower layers, with fake responses.
+
+class FakeResponse:
+    """Like an http.client.HTTPResponse with the given body."""
+    def __init__(self, body, headers=None):
+        self.body = io.BytesIO(body)
+        self.headers = headers or {}
+
+    def read(self, size):
+        return self.body.read(size)
+
+    def getheader(self, name):
+        return self.headers.get(name)
+
+
+def test_read_lines():
+    text = 'first\r\nsecond ñ ☃\nthird\u2028same line\r\n\nlast'
+    expected = ['first', 'second ñ ☃', 'third\u2028same line', '', 'last']
+
+    body = text.encode()
+    for size in [1, 2, 3, 5, 1000]:  # splitting '\r\n' and utf-8 characters
+        lines = ez.read_lines(FakeResponse(body), size)
+        assert list(lines) == expected
+
+    body_gz = gzip.compress(text.encode())
+    for size in [1, 7, 1000]:
+        lines = ez.read_lines(FakeResponse(body_gz, {'Content-Encoding':
+                                                     'gzip'}), size)
+        assert list(lines) == expected
+
+    # A line much longer than the chunks (like a sequence in one line).
+    long_line = 'ñACGT' * 20000 + '\r'
+    body = f'<seq>\n{long_line}\nend'.encode()
+    lines = ez.read_lines(FakeResponse(body), 10)
+    assert list(lines) == ['<seq>', long_line[:-1], 'end']
+
+    assert list(ez.read_lines(FakeResponse(b''))) == []
+    assert list(ez.read_lines(FakeResponse(b'a\n'))) == ['a']
+
+
+def test_encode_query(monkeypatch):
+    monkeypatch.setattr(ez, 'EMAIL', None)
+    monkeypatch.setattr(ez, 'API_KEY', None)
+
+    # Lists of values are sent as repeated parameters.
+    data = ez.encode_query('fetch', '', {'db': 'snp', 'id': [1, 2, 3]})
+    assert data == 'db=snp&id=1&id=2&id=3'
+
+    # Required arguments can come in raw_params too.
+    data = ez.encode_query('search', '&term=a%5Baccn%5D', {'db': 'nuccore'})
+    assert data == 'db=nuccore&term=a%5Baccn%5D'
+
+    with pytest.raises(AssertionError):
+        ez.encode_query('search', '', {'db': 'nuccore'})  # missing term
+
+    with pytest.raises(AssertionError):
+        ez.encode_query('fetch', '', {'db': 'snp', 'wrong': 1})
+
+
+def test_cache(monkeypatch, tmp_path):
+    requests = []  # data of the requests that reach the (fake) server
+
+    def fake_http_post(path, data):
+        requests.append(data)
+        yield from ['<a>', 'ñ\u2028☃', '', '</a>']
+
+    monkeypatch.setattr(ez, 'http_post', fake_http_post)
+    monkeypatch.setattr(ez, 'wait_turn', lambda has_key=False: None)
+    monkeypatch.setattr(ez, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(ez, 'CACHE_TTL', None)
+
+    # A response read only partially is not saved.
+    lines = ez.post_query('fetch', 'db=snp&id=1')
+    assert next(lines) == '<a>'
+    lines.close()
+    assert list(tmp_path.iterdir()) == []  # not even a temporary file
+
+    # A complete one is saved, and read from the cache afterwards.
+    assert list(ez.post_query('fetch', 'db=snp&id=1')) == [
+        '<a>', 'ñ\u2028☃', '', '</a>']
+    assert list(ez.post_query('fetch', 'db=snp&id=1')) == [
+        '<a>', 'ñ\u2028☃', '', '</a>']
+    assert len(requests) == 2  # the one read partially, and the first full
+
+    # Unless we ask not to use it.
+    list(ez.post_query('fetch', 'db=snp&id=1', use_cache=False))
+    assert len(requests) == 3
+
+    ez.clear_cache()
+    assert list(tmp_path.iterdir()) == []
@@ -14,33 +14,73 @@ results before 5:00 EST (10:00 GMT).
 """
 
 import sys
+import os
 import re
 import time
+import json
+import hashlib
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter as fmt
 import requests
 
+session = requests.Session()  # reuses the connection for all the requests
+
+# Regular expressions to extract the values that we need from the responses.
+rid_regexp = re.compile(r'RID = (.*)')  # request id
+rtoe_regexp = re.compile(r'RTOE = (.*)')  # estimated wait time
+status_regexp = re.compile(r'Status=(.*)')
+
+RID_CACHE_TTL = 23 * 3600  # seconds to reuse a rid (results last 24 h)
+
 
 def main():
     args = get_args()
 
     try:
-        rid, rtoe = send_query(args.fasta_files, args.program,
-                               args.urlbase, args.database)
-        print(f'Got a request id {rid}. Estimated wait of {rtoe} s. Waiting.')
+        params, query = read_query(args.fasta_files, args.program,
+                                   args.database)
 
-        time.sleep(rtoe)  # wait for search to complete
+        # Identifier of the query, for the cache of rids.
+        key = hashlib.sha256(repr(sorted(params.items())).encode() + b'\0' +
+                             args.urlbase.encode() + b'\0' + query).hexdigest()
+
+        rids = load_rids(args.rid_cache) if args.rid_cache else {}
+
+        if key in rids:
+            rid, _ = rids[key]
+            rtoe = 0
+            print(f'Reusing request id {rid} from {args.rid_cache}')
+        else:
+            sent = time.time()
+            rid, rtoe = send_query(args.urlbase, params, query)
+            print(f'Got a request id {rid}. Estimated wait of {rtoe} s.')
 
         url_info = f'{args.urlbase}?CMD=Get&FORMAT_OBJECT=SearchInfo&RID={rid}'
-        print(f'Checking every {args.wait} s the status at {url_info}')
+        print(f'Checking periodically the status at {url_info}')
+
+        try:
+            check_periodically(url_info, args.wait, args.max_wait, rtoe,
+                               just_sent=(key not in rids))
+        except (RuntimeError, ValueError):
+            if key in rids:  # the rid is no good, so don't reuse it again
+                update_rids(args.rid_cache, key, None)
+            raise
 
-        check_periodically(url_info, args.wait)  # check until we have results
+        if args.rid_cache and key not in rids:  # remember the good rid
+            update_rids(args.rid_cache, key, [rid, sent])
 
         url_results = f'{args.urlbase}?CMD=Get&FORMAT_TYPE={args.format}&RID={rid}'
         print(f'Retrieving results from {url_results}')
 
-        results = requests.get(url_results).text.strip()  # get the results
-
-        output_results(results, args.format, args.output)
+        with session.get(url_results, stream=True) as response:
+            if args.output and args.format not in ['Text', 'Tabular']:
+                # Nothing to clean, so we write them as they come.
+                save_stripped(response.iter_content(1 << 16), args.output)
+                print(f'Results written to: {args.output}')
+            else:
+                # Decode them directly (they are utf-8), which for big results
+                # is much faster than letting requests guess the encoding.
+                results = response.content.decode('utf-8', 'replace')
+                output_results(results, args.format, args.output)
 
     except (OSError, RuntimeError, KeyboardInterrupt) as e:
         sys.exit(e)
@@ -77,45 +117,119 @@ def get_args():
         choices=['Text', 'Tabular', 'XML', 'XML2', 'HTML', 'JSON2'])
     add('-o', '--output', help='if given, file where to write the results')
     add('--wait', type=int, default=5, help='seconds to wait between checks')
+    add('--max-wait', type=int, default=30,
+        help='maximum seconds to wait between checks, for long searches')
+    add('--rid-cache', metavar='FILE',
+        help='if given, file where to remember the request ids, to reuse '
+        'them (for up to 23 h) when making the same query again')
     add('--urlbase', default='https://blast.ncbi.nlm.nih.gov/blast/Blast.cgi',
         help='base url where to contact the blast web api')
 
     return parser.parse_args()
 
 
-def send_query(fasta_files, program, urlbase, database):
-    """Send query with contents of fasta files and return rid and rtoe."""
-    # The "query" will be the contents of all the given fasta files.
-    fastas = ''.join(open(fname).read() for fname in fasta_files)
+def read_query(fasta_files, program, database):
+    """Return the parameters and query (contents of fasta files) to send."""
+    # The "query" will be the contents of all the given fasta files (read as
+    # bytes, since we only need to send them).
+    query = bytearray()
+    for fname in fasta_files:
+        with open(fname, 'rb') as f:
+            query += f.read()
+
+    params = {'CMD': 'Put', 'PROGRAM': program, 'DATABASE': database}
 
-    replacements = {'megablast': 'blastn&MEGABLAST=on',
-                    'rpsblast': 'blastp&SERVICE=rpsblast'}
-    program_str = replacements.get(program, program)
+    replacements = {'megablast': {'PROGRAM': 'blastn', 'MEGABLAST': 'on'},
+                    'rpsblast': {'PROGRAM': 'blastp', 'SERVICE': 'rpsblast'}}
+    params.update(replacements.get(program, {}))
 
-    url_noquery = (f'{urlbase}?CMD=Put&PROGRAM={program_str}'
-                   f'&DATABASE={database}&QUERY=')
+    return params, bytes(query)
+
+
+def send_query(urlbase, params, query):
+    """Send query with the given parameters and return rid and rtoe."""
+    url_noquery = urlbase + '?' + '&'.join(f'{k}={v}'
+                                           for k, v in params.items())
 
     print(f'Making request to {url_noquery}[...]')  # show url without the query
 
-    req_query = requests.post(url_noquery + requests.utils.quote(fastas))
+    # Send the query in the body of the post (form-encoded by requests).
+    req_query = session.post(urlbase, data=dict(params, QUERY=query))
 
-    rid = re.findall('RID = (.*)', req_query.text)[0]  # request id
-    rtoe = re.findall('RTOE = (.*)', req_query.text)[0]  # estimated wait time
+    rid = extract(rid_regexp, req_query.text)
+    rtoe = extract(rtoe_regexp, req_query.text)
 
     return rid, int(rtoe)
 
 
-def check_periodically(url, wait=5):
+def load_rids(fname):
+    """Return dict {query_hash: [rid, timestamp]} with the recent rids."""
+    try:
+        with open(os.path.expanduser(fname)) as f:
+            rids = json.load(f)
+
+        now = time.time()
+        return {k: v for k, v in rids.items() if now - v[1] < RID_CACHE_TTL}
+    except FileNotFoundError:
+        return {}  # no cache yet, so we start a new one
+    except (ValueError, TypeError, IndexError, KeyError, AttributeError):
+        return {}  # not a cache that we wrote, so we start a new one too
+
+
+def update_rids(fname, key, value):
+    """Set in the rids file the key to value (or remove it if None)."""
+    rids = load_rids(fname)
+    if value is None:
+        rids.pop(key, None)
+    else:
+        rids[key] = value
+    save_rids(fname, rids)
+
+
+def save_rids(fname, rids):
+    """Save the dict of rids in file fname."""
+    fname = os.path.expanduser(fname)
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    tmp = fname + '.tmp'
+    with open(tmp, 'wt') as f:
+        json.dump(rids, f)
+    os.replace(tmp, fname)  # so the file is never half-written
+
+
+def extract(regexp, text):
+    """Return the value captured by the first match of regexp in text."""
+    match = regexp.search(text)
+    if not match:
+        raise ValueError(f'Cannot find {regexp.pattern!r} in the response')
+    return match.group(1)
+
+
+def check_periodically(url, wait=5, max_wait=30, rtoe=0, just_sent=True):
     """Keep checking the status from the given url until we have results."""
+    # We check soon (small searches are often ready well before their
+    # estimated time rtoe), and then wait longer and longer, starting with
+    # a fraction of rtoe (or wait seconds) and up to max_wait seconds.
+    min_wait = max(2, wait)  # never less than 2 s, to respect NCBI's limit
+    max_wait = max(min_wait, max_wait)
+    delay = min(max_wait, max(min_wait, rtoe // 4))
+
+    if just_sent:  # we made a request (the query) right before
+        time.sleep(min_wait)
+
     status = None
     while status != 'READY':
-        print('.', end='')  # just to show the passage of time
-        sys.stdout.flush()
+        print('.', end='', flush=True)  # just to show the passage of time
 
-        status = re.findall('Status=(.*)', requests.get(url).text)[0]
+        response = session.get(url)
+        status = extract(status_regexp, response.text)
 
         if status == 'WAITING':
-            time.sleep(wait)
+            # If the server tells us how long to wait, we do that instead
+            # (but never less than min_wait).
+            retry_after = response.headers.get('Retry-After', '')
+            time.sleep(max(min_wait, int(retry_after)) if retry_after.isdigit()
+                       else delay)
+            delay = min(max_wait, 1.5 * delay)
         elif status != 'READY':
             print()
             raise RuntimeError(f'Finished with status: {status}')
@@ -128,12 +242,16 @@ def output_results(results, fmt, output):
     try:
         # Clear the text for certain formats that return ugly text.
         if fmt == 'Tabular':  # the actual result is between <PRE></PRE>
-            results = re.findall('<PRE>(.*)</PRE>', results, re.S)[0].strip()
+            start = results.index('<PRE>') + len('<PRE>')
+            end = results.rindex('</PRE>', start)  # the last one
+            results = results[start:end]
         elif fmt == 'Text':  # the actual result is just after <PRE>
-            results = re.findall('<PRE>(.*)', results, re.S)[0].strip()
-    except IndexError as e:
+            results = results[results.index('<PRE>') + len('<PRE>'):]
+    except ValueError as e:
         raise RuntimeError(f'Output format of results looks wrong: {results}')
 
+    results = results.strip()
+
     # Save to file or print on screen the results.
     if output is not None:
         open(output, 'wt').write(results)
@@ -142,6 +260,24 @@ def output_results(results, fmt, output):
         print(results)
 
 
+def save_stripped(chunks, fname):
+    """Write the chunks of bytes to file fname, without surrounding spaces."""
+    with open(fname, 'wb') as out:
+        started = False
+        pending = b''  # whitespace that we write only if more content follows
+        for chunk in chunks:
+            if not started:
+                chunk = chunk.lstrip()
+                started = bool(chunk)
+
+            content = chunk.rstrip()
+            if content:
+                out.write(pending + content)
+                pending = chunk[len(content):]
+            else:
+                pending += chunk
+
+
 
 if __name__ == '__main__':
     main()